@@ -4,10 +4,11 @@ Objects/utility for asyncio-based objects.
 from __future__ import annotations
 
 import asyncio
+import concurrent.futures
 import threading
 import warnings
-from types import SimpleNamespace
-from typing import TypeVar, Generic, List, Generator, Any, Type, Union, Optional
+from typing import TypeVar, Generic, List, Generator, Any, Type, Union, Optional, Tuple, Set
+from weakref import WeakValueDictionary
 
 from clearcut import get_logger
 
@@ -16,25 +17,72 @@ logger = get_logger(__name__)
 LPT = TypeVar("LPT")
 
 
+class _GlobalState:
+    """State of a proxy shared by all threads."""
+
+    __slots__ = ("obj", "inited", "entered", "aenter_future", "cleaned_up")
+
+    def __init__(self):
+        self.obj = None
+        self.inited = False
+        self.entered = False
+        self.aenter_future = None
+        self.cleaned_up = False
+
+
+class _ThreadLocalState(threading.local):
+    """State of a thread-local proxy. The class attributes are the defaults each thread starts with."""
+
+    obj = None
+    inited = False
+    entered = False
+    aenter_future = None
+    cleaned_up = False
+
+
 class BaseLazyProxy(Generic[LPT]):
     """
     Base of both standard and aio lazy proxies.
     """
 
-    _proxy_registry: List[BaseLazyProxy] = []
-    """This is a global registry of created proxies. Is used to cleanup."""
+    # Slotted since apps may declare many of these at module level.
+    __slots__ = (
+        "__weakref__",
+        "_thread_local",
+        "_state",
+        "_proxied_type",
+        "_args",
+        "_kwargs",
+        "_has_enter",
+        "_has_exit",
+        "_has_aenter",
+        "_has_aexit",
+        "_std_deps",
+        "_aio_deps",
+        "_init_lock",
+    )
+
+    # Registries are keyed by id() and kept in the order proxies were first entered, which puts deps before what depends on them. Weak so
+    # that unreferenced proxies can still be collected.
+
+    _sync_registry: WeakValueDictionary[int, BaseLazyProxy] = WeakValueDictionary()
+    """Global registry of entered proxies whose objects need __exit__'ing."""
+
+    _aio_registry: WeakValueDictionary[int, BaseLazyProxy] = WeakValueDictionary()
+    """Global registry of entered proxies whose objects need __aexit__'ing."""
 
     _cleanup_lock: threading.Lock = threading.Lock()
 
+    _state_lock: threading.Lock = threading.Lock()
+    """Shared by all proxies, but only held briefly for bookkeeping (e.g. creating per-proxy locks), never while running user code."""
+
     def __init__(self, obj_or_class: Union[LPT, Type[LPT]], thread_local: Optional[bool] = None):
         """
         Pass in an init'ed object, or a type, to delegate it to the lazy proxy. If a type is passed in, both __init__ and enter/aenter
         will be delayed.
         """
 
-        # self._enter_lock: threading.Lock = asyncio.Lock()
-        logger.debug(f"Making baselazyproxy for {obj_or_class} in thread {threading.current_thread().name}")
-        self._init_lock: threading.Lock = threading.Lock()
+        logger.debug("Making baselazyproxy for %s in thread %s", obj_or_class, threading.current_thread().name)
 
         if thread_local is None:
             if isinstance(obj_or_class, type):
@@ -43,27 +91,34 @@ class BaseLazyProxy(Generic[LPT]):
                 thread_local = False
         self._thread_local: bool = thread_local
 
-        self._thread_local_storage: threading.local = threading.local()
-        self._global_storage = SimpleNamespace()
+        # Per-proxy slow path lock. Created on first use, since most proxies only init once and many never do.
+        self._init_lock: Optional[threading.Lock] = None
 
-        BaseLazyProxy._proxy_registry.append(self)
+        # Both kinds of state have the same attributes, so accessors don't need to know which mode this proxy is in.
+        self._state: Union[_GlobalState, _ThreadLocalState] = _ThreadLocalState() if thread_local else _GlobalState()
 
         if isinstance(obj_or_class, type):
-            logger.debug(f"Making baselazyproxy for type {obj_or_class} in thread {threading.current_thread().name}")
+            logger.debug("Making baselazyproxy for type %s in thread %s", obj_or_class, threading.current_thread().name)
             self._proxied_type: Type[LPT] = obj_or_class
-            self._store_obj(None)
-            self._store_inited(False)
-            self._store_entered(False)
             self._args = tuple()
             self._kwargs = dict()
         else:
             self._proxied_type: Type[LPT] = type(obj_or_class)
             self._store_obj(obj_or_class)
             self._store_inited(True)
-            self._store_entered(False)
             self._args = None
             self._kwargs = None
 
+        # Context manager protocols are looked up on the type, so these can be checked once rather than on every enter/cleanup.
+        self._has_enter: bool = hasattr(self._proxied_type, "__enter__")
+        self._has_exit: bool = hasattr(self._proxied_type, "__exit__")
+        self._has_aenter: bool = hasattr(self._proxied_type, "__aenter__")
+        self._has_aexit: bool = hasattr(self._proxied_type, "__aexit__")
+
+        # Proxied args/kwargs which need entering before this one. Only known once __call__ is made.
+        self._std_deps: Tuple[StandardLazyProxy, ...] = ()
+        self._aio_deps: Tuple[AIOLazyProxy, ...] = ()
+
     def __call__(self, *args, **kwargs):
         if self._is_inited():
             warnings.warn("Object already init'ed. args/kwargs will have no effect")
@@ -72,70 +127,139 @@ class BaseLazyProxy(Generic[LPT]):
             self._args = args
             self._kwargs = kwargs
 
+            deps = (*args, *kwargs.values())
+            self._std_deps = tuple(dep for dep in deps if isinstance(dep, StandardLazyProxy))
+            self._aio_deps = tuple(dep for dep in deps if isinstance(dep, AIOLazyProxy))
+
             return self
 
-    def _init_if_necessary(self) -> LPT:
-        logger.debug(f"init'ing if necessary instance of {self._proxied_type.__qualname__} in thread {threading.current_thread().name}")
+    def _get_init_lock(self) -> threading.Lock:
+        lock = self._init_lock
+        if lock is None:
+            with BaseLazyProxy._state_lock:
+                lock = self._init_lock
+                if lock is None:
+                    lock = self._init_lock = threading.Lock()
+        return lock
+
+    def _init_lazily(self) -> LPT:
         if not self._is_inited():
-            with self._init_lock:
+            with self._get_init_lock():
                 if not self._is_inited():
                     # Needs init'ing
-                    logger.debug(f"Init'ing new instance of {self._proxied_type.__qualname__} in thread {threading.current_thread().name}")
+                    logger.debug("Init'ing new instance of %s in thread %s", self._proxied_type.__qualname__, threading.current_thread().name)
                     # Replace any args or kwargs that are proxies with their proxied objects. We'll enter/aenter later.
                     args = [arg.unmanaged_object if isinstance(arg, BaseLazyProxy) else arg for arg in self._args]
                     kwargs = {k: arg.unmanaged_object if isinstance(arg, BaseLazyProxy) else arg for k, arg in self._kwargs.items()}
 
                     self._store_obj(self._proxied_type(*args, **kwargs))
                     self._store_inited(True)
+
+                    if not self._thread_local:
+                        # Won't be init'ed again (unlike thread-local proxies, which init once per thread), so stop holding onto args. This
+                        # only releases the non-proxy ones: proxied args are still held by _std_deps/_aio_deps, which are needed to enter
+                        # them and to order cleanup.
+                        self._args = None
+                        self._kwargs = None
                 else:
                     logger.debug(
-                        f"Not init'ing new instance of {self._proxied_type.__qualname__} in thread {threading.current_thread().name}"
+                        "Not init'ing new instance of %s in thread %s", self._proxied_type.__qualname__, threading.current_thread().name
                     )
 
         return self._get_obj()
 
-    def _correct_storage(self) -> Union[SimpleNamespace, threading.local]:
-        if self._thread_local:
-            return self._thread_local_storage
-        else:
-            return self._global_storage
+    def _init_if_necessary(self) -> LPT:
+        state = self._state
+        if state.inited:
+            return state.obj
+        return self._init_lazily()
 
     def _store_obj(self, obj: LPT):
-        self._correct_storage().obj = obj
+        self._state.obj = obj
 
     def _get_obj(self) -> LPT:
-        return self._correct_storage().obj
+        return self._state.obj
 
     def _is_inited(self) -> bool:
-        return getattr(self._correct_storage(), "inited", False)
+        return self._state.inited
 
     def _store_inited(self, inited: bool):
-        self._correct_storage().inited = inited
+        self._state.inited = inited
 
     def _is_entered(self) -> bool:
-        return getattr(self._correct_storage(), "entered", False)
+        return self._state.entered
 
     def _store_entered(self, entered: bool):
-        self._correct_storage().entered = entered
+        self._state.entered = entered
+
+    def _needs_cleanup(self) -> bool:
+        state = self._state
+        return state.inited and state.entered and not state.cleaned_up
+
+    def _register_for_cleanup(self):
+        if self._has_aexit:
+            registry = BaseLazyProxy._aio_registry
+        elif self._has_exit:
+            registry = BaseLazyProxy._sync_registry
+        else:
+            return
+
+        with BaseLazyProxy._state_lock:
+            if registry.get(id(self)) is not self:
+                # Drop any entry left by a collected proxy with the same id, so this one goes at the end.
+                registry.pop(id(self), None)
+                registry[id(self)] = self
+
+    def _transitive_deps(self) -> Set[BaseLazyProxy]:
+        """Every proxy this one depends on, directly or through other proxies (including ones with nothing to clean up)."""
+        deps = set()
+        to_visit = [*self._std_deps, *self._aio_deps]
+        while to_visit:
+            dep = to_visit.pop()
+            if dep not in deps:
+                deps.add(dep)
+                to_visit.extend((*dep._std_deps, *dep._aio_deps))
+        return deps
 
     @property
     def unmanaged_object(self) -> LPT:
         """Init'ed object that may or may not be within its enter/exit lifecycle. Generally should not be used except for internal util."""
         return self._init_if_necessary()
 
+    @classmethod
+    def _claim_entered(cls, registry: WeakValueDictionary[int, BaseLazyProxy]) -> List[BaseLazyProxy]:
+        """
+        Claims the proxies in the registry needing cleanup, in entry order. Claiming is done under the lock so concurrent cleanups never exit
+        the same object, but the exiting happens after, outside it.
+        """
+        with cls._cleanup_lock:
+            claimed = [proxy for proxy in list(registry.values()) if proxy._needs_cleanup()]
+            for proxy in claimed:
+                proxy._state.cleaned_up = True
+            return claimed
+
+    @staticmethod
+    def _exit(proxy: BaseLazyProxy, exc_type, exc_val, exc_tb):
+        obj = proxy._get_obj()
+        logger.debug("Cleaning up %r", obj)
+        try:
+            obj.__exit__(exc_type, exc_val, exc_tb)
+        except Exception:
+            # One failure shouldn't stop the others being cleaned up.
+            logger.error("Error cleaning up %r", obj, exc_info=True)
+
     @classmethod
     def cleanup_sync(cls, exc_type, exc_val, exc_tb):
         """
         Cleans up all LazyProxy instances which have been instantiated.
         """
-        with cls._cleanup_lock:
-            for proxy in cls._proxy_registry:
-                if proxy._is_inited() and proxy._is_entered():
-                    if hasattr(proxy.unmanaged_object, "__aexit__"):
-                        logger.warning(f"Unable to clean up aio proxied: {repr(proxy.unmanaged_object)}")
-                    elif hasattr(proxy.unmanaged_object, "__exit__"):
-                        logger.debug(f"Cleaning up {repr(proxy.unmanaged_object)}")
-                        proxy.unmanaged_object.__exit__(exc_type, exc_val, exc_tb)
+        for proxy in list(cls._aio_registry.values()):
+            if proxy._needs_cleanup():
+                logger.warning("Unable to clean up aio proxied: %r", proxy._get_obj())
+
+        # Reverse of the order entered, so nothing is exited before what depends on it.
+        for proxy in reversed(cls._claim_entered(cls._sync_registry)):
+            cls._exit(proxy, exc_type, exc_val, exc_tb)
 
     @classmethod
     async def cleanup(cls, exc_type, exc_val, exc_tb):
@@ -143,15 +267,26 @@ class BaseLazyProxy(Generic[LPT]):
         Cleans up all LazyProxy instances which have been instantiated.
         """
         # TODO call this automatically somehow?
-        with cls._cleanup_lock:
-            for proxy in cls._proxy_registry:
-                if proxy._is_inited() and proxy._is_entered():
-                    if hasattr(proxy.unmanaged_object, "__aexit__"):
-                        logger.debug(f"Cleaning up {repr(proxy.unmanaged_object)}")
-                        await proxy.unmanaged_object.__aexit__(exc_type, exc_val, exc_tb)
-                    elif hasattr(proxy.unmanaged_object, "__exit__"):
-                        logger.debug(f"Cleaning up {repr(proxy.unmanaged_object)}")
-                        proxy.unmanaged_object.__exit__(exc_type, exc_val, exc_tb)
+        pending = [*cls._claim_entered(cls._aio_registry), *cls._claim_entered(cls._sync_registry)]
+        deps_of = {proxy: proxy._transitive_deps() for proxy in pending}
+
+        # Exit in waves: a proxy is only exited once everything depending on it has been, and each wave's aexits run concurrently.
+        while pending:
+            depended_on = set().union(*(deps_of[proxy] for proxy in pending))
+            wave = [proxy for proxy in pending if proxy not in depended_on] or pending
+            pending = [proxy for proxy in pending if proxy not in wave]
+
+            aio_objs = [proxy._get_obj() for proxy in wave if proxy._has_aexit]
+            logger.debug("Cleaning up %r", aio_objs)
+            # One failure shouldn't stop the others being cleaned up.
+            results = await asyncio.gather(*(obj.__aexit__(exc_type, exc_val, exc_tb) for obj in aio_objs), return_exceptions=True)
+            for obj, result in zip(aio_objs, results):
+                if isinstance(result, BaseException):
+                    logger.error("Error cleaning up %r", obj, exc_info=result)
+
+            for proxy in reversed(wave):
+                if not proxy._has_aexit:
+                    cls._exit(proxy, exc_type, exc_val, exc_tb)
 
 
 class AIOLazyProxy(BaseLazyProxy, Generic[LPT]):
@@ -170,48 +305,58 @@ class AIOLazyProxy(BaseLazyProxy, Generic[LPT]):
     by `async with client as c` (this async context manager won't kill the underlying object until the app closes).
 
     Coupled with app shutdown, `await AIOLazyProxy.cleanup()` to cleanup all loaded objects.
+
+    Nothing tied to an event loop is created until the first `await`, and then only in the running loop. So proxies can be declared at import
+    time, before any loop exists, and used with whichever loop the app ends up running (e.g. uvloop). Thread-local proxies (the default when
+    a type is passed) can also be awaited from several threads' loops at once. A global proxy's object is aenter'ed in the first loop to
+    await it, so other threads' loops can only use it if the object isn't bound to that loop.
     """
 
-    def __init__(self, obj_or_class: Union[LPT, Type[LPT]], thread_local: Optional[bool] = None):
-        super().__init__(obj_or_class, thread_local)
-        logger.debug(
-            f"creating aenter lock in thread {threading.current_thread().name} with loop {asyncio.get_event_loop()} / {id(asyncio.get_event_loop())}"
-        )
-        self._aenter_lock: asyncio.Lock = asyncio.Lock()
+    __slots__ = ()
 
     async def _aenter_if_necessary(self):
-        if not self._is_entered():
-            logger.debug(
-                f"checking aenter lock in thread {threading.current_thread().name} / {id(threading.current_thread())} with loop {self._aenter_lock._loop} / {id(self._aenter_lock._loop)} of {self._proxied_type.__qualname__} in thread {threading.current_thread().name} with loop {asyncio.get_event_loop()} / {id(asyncio.get_event_loop())}"
-            )
-            async with self._aenter_lock:
-                if not self._is_entered():
-                    logger.debug(
-                        f"aenter'ing new instance of {self._proxied_type.__qualname__} in thread {threading.current_thread().name}"
-                    )
-                    # Needs loading
-                    # First enter any deps
-                    for arg in self._args:
-                        if isinstance(arg, StandardLazyProxy):
-                            # noinspection PyProtectedMember
-                            arg._enter_if_necessary()
-                        elif isinstance(arg, AIOLazyProxy):
-                            await arg._aenter_if_necessary()
-
-                    for arg in self._kwargs.values():
-                        if isinstance(arg, StandardLazyProxy):
-                            # noinspection PyProtectedMember
-                            arg._enter_if_necessary()
-                        elif isinstance(arg, AIOLazyProxy):
-                            await arg._aenter_if_necessary()
-
-                    # Then enter this one
-                    if hasattr(self.unmanaged_object, "__aenter__"):
-                        logger.debug(f"Loading {repr(self.unmanaged_object)}")
-                        await self.unmanaged_object.__aenter__()
-                    self._store_entered(True)
+        while not self._is_entered():
+            # The first awaiter does the aenter'ing, and leaves a future for any others to wait on. It's a concurrent future rather than an
+            # asyncio one since a global proxy's other awaiters may be in other threads, running other loops.
+            with BaseLazyProxy._state_lock:
+                in_progress = self._state.aenter_future
+                if in_progress is None:
+                    aentering = self._state.aenter_future = concurrent.futures.Future()
+
+            if in_progress is not None:
+                logger.debug("waiting on aenter of %s in thread %s", self._proxied_type.__qualname__, threading.current_thread().name)
+                # Only signals completion. If that aenter failed, loop around and try again ourselves. wrap_future wakes this loop
+                # thread-safely once it's done.
+                await asyncio.wait((asyncio.wrap_future(in_progress),))
+                continue
+
+            try:
+                await self._aenter()
+            finally:
+                self._state.aenter_future = None
+                aentering.set_result(None)
+
+        # Entered implies init'ed, so the object can be read directly.
+        return self._get_obj()
 
-        return self.unmanaged_object
+    async def _aenter(self):
+        logger.debug("aenter'ing new instance of %s in thread %s", self._proxied_type.__qualname__, threading.current_thread().name)
+        # Needs loading
+        # First enter any deps
+        for dep in self._std_deps:
+            # noinspection PyProtectedMember
+            dep._enter_if_necessary()
+
+        for dep in self._aio_deps:
+            await dep._aenter_if_necessary()
+
+        # Then enter this one
+        obj = self.unmanaged_object
+        if self._has_aenter:
+            logger.debug("Loading %r", obj)
+            await obj.__aenter__()
+        self._store_entered(True)
+        self._register_for_cleanup()
 
     def __await__(self) -> Generator[Any, None, LPT]:
         return self._aenter_if_necessary().__await__()
@@ -241,32 +386,42 @@ class StandardLazyProxy(BaseLazyProxy, Generic[LPT]):
     Coupled with app shutdown, `await StandardLazyProxy.cleanup()` to aexit all loaded objects.
     """
 
+    __slots__ = ("_enter_lock",)
+
     def __init__(self, obj_or_class: Union[LPT, Type[LPT]], thread_local: Optional[bool] = None):
         super().__init__(obj_or_class, thread_local)
-        self._enter_lock: threading.Lock = threading.Lock()
+        # Created on first use, like _init_lock.
+        self._enter_lock: Optional[threading.Lock] = None
+
+    def _get_enter_lock(self) -> threading.Lock:
+        lock = self._enter_lock
+        if lock is None:
+            with BaseLazyProxy._state_lock:
+                lock = self._enter_lock
+                if lock is None:
+                    lock = self._enter_lock = threading.Lock()
+        return lock
 
     def _enter_if_necessary(self) -> LPT:
         if not self._is_entered():
-            with self._enter_lock:
+            with self._get_enter_lock():
                 if not self._is_entered():
-                    logger.debug(f"enter'ing new instance of {self._proxied_type.__qualname__} in thread {threading.current_thread().name}")
+                    logger.debug("enter'ing new instance of %s in thread %s", self._proxied_type.__qualname__, threading.current_thread().name)
                     # Needs loading
                     # First enter any deps
-                    for arg in self._args:
-                        if isinstance(arg, StandardLazyProxy):
-                            arg._enter_if_necessary()
-
-                    for arg in self._kwargs.values():
-                        if isinstance(arg, StandardLazyProxy):
-                            arg._enter_if_necessary()
+                    for dep in self._std_deps:
+                        dep._enter_if_necessary()
 
                     # Then enter this one
-                    if hasattr(self.unmanaged_object, "__enter__"):
-                        logger.debug(f"Loading {repr(self.unmanaged_object)}")
-                        self.unmanaged_object.__enter__()
+                    obj = self.unmanaged_object
+                    if self._has_enter:
+                        logger.debug("Loading %r", obj)
+                        obj.__enter__()
                     self._store_entered(True)
+                    self._register_for_cleanup()
 
-        return self.unmanaged_object
+        # Entered implies init'ed, so the object can be read directly.
+        return self._get_obj()
 
     @property
     def __(self) -> LPT: